@@ -2,38 +2,92 @@
 from __future__ import annotations
 
 import json
+import itertools
 import os
+import re
+import threading
 import uuid
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from cachetools import TTLCache
 
 from sqlalchemy import (
     Boolean,
     Column,
     DateTime,
     Float,
+    Index,
     Integer,
+    JSON,
     MetaData,
     String,
     Table,
+    UniqueConstraint,
+    and_,
+    bindparam,
+    case,
+    cast,
     create_engine,
+    func,
+    inspect,
+    literal,
+    null,
     select,
+    text,
+    type_coerce,
+    union_all,
     update,
 )
-from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection, Engine, make_url
 from sqlalchemy.pool import StaticPool
 
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
+
 metadata = MetaData()
 
 
+def _json_default(value: Any) -> str:
+    # mirror orjson, which writes datetimes in row dicts as ISO 8601
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def json_dumps(value: Any) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode()
+        except TypeError:  # orjson.JSONEncodeError, e.g. ints wider than 64 bits
+            pass
+    return json.dumps(value, default=_json_default)
+
+
+# orjson reads integers beyond 64 bits as floats; such long digit runs go to stdlib
+_LONG_DIGITS = re.compile(r"\d{19}")
+_LONG_DIGITS_BYTES = re.compile(rb"\d{19}")
+
+
+def json_loads(value: Any) -> Any:
+    if orjson is not None:
+        pattern = _LONG_DIGITS if isinstance(value, str) else _LONG_DIGITS_BYTES
+        if not pattern.search(value):
+            return orjson.loads(value)
+    return json.loads(value)
+
+
 def _uuid() -> str:
-    return str(uuid.uuid4())
+    return uuid.uuid4().hex
 
 
 patients = Table(
     "patients",
     metadata,
-    Column("id", String(36), primary_key=True, default=_uuid),
+    Column("id", String(32), primary_key=True, default=_uuid),
     Column("full_name", String(255), nullable=False),
     Column("dob", String(50), nullable=False),
     Column("phone", String(50)),
@@ -44,8 +98,8 @@ patients = Table(
 family_members = Table(
     "family_members",
     metadata,
-    Column("id", String(36), primary_key=True, default=_uuid),
-    Column("patient_id", String(36), nullable=False),
+    Column("id", String(32), primary_key=True, default=_uuid),
+    Column("patient_id", String(32), nullable=False, index=True),
     Column("full_name", String(255), nullable=False),
     Column("relationship", String(100), nullable=False),
     Column("photo_blob_path", String(500)),
@@ -55,8 +109,8 @@ family_members = Table(
 knowledge_items = Table(
     "knowledge_items",
     metadata,
-    Column("id", String(36), primary_key=True, default=_uuid),
-    Column("patient_id", String(36), nullable=False),
+    Column("id", String(32), primary_key=True, default=_uuid),
+    Column("patient_id", String(32), nullable=False, index=True),
     Column("category", String(100), nullable=False),
     Column("label", String(255), nullable=False),
     Column("value", String(500), nullable=False),
@@ -68,8 +122,8 @@ knowledge_items = Table(
 quiz_sessions = Table(
     "quiz_sessions",
     metadata,
-    Column("id", String(36), primary_key=True, default=_uuid),
-    Column("patient_id", String(36), nullable=False),
+    Column("id", String(32), primary_key=True, default=_uuid),
+    Column("patient_id", String(32), nullable=False, index=True),
     Column("created_at", DateTime, default=datetime.utcnow),
     Column("status", String(50)),
     Column("total_questions", Integer),
@@ -80,10 +134,11 @@ quiz_sessions = Table(
 quiz_questions = Table(
     "quiz_questions",
     metadata,
-    Column("id", String(36), primary_key=True, default=_uuid),
-    Column("session_id", String(36), nullable=False),
+    Column("id", String(32), primary_key=True, default=_uuid),
+    Column("session_id", String(32), nullable=False, index=True),
     Column("question_type", String(50), nullable=False),
-    Column("payload_json", String(4000), nullable=False),
+    Column("item_type", String(50), index=True),
+    Column("payload_json", JSON, nullable=False),
     Column("correct_answer_json", String(2000)),
     Column("created_at", DateTime, default=datetime.utcnow),
 )
@@ -91,9 +146,9 @@ quiz_questions = Table(
 quiz_responses = Table(
     "quiz_responses",
     metadata,
-    Column("id", String(36), primary_key=True, default=_uuid),
-    Column("session_id", String(36), nullable=False),
-    Column("question_id", String(36), nullable=False),
+    Column("id", String(32), primary_key=True, default=_uuid),
+    Column("session_id", String(32), nullable=False, index=True),
+    Column("question_id", String(32), nullable=False, index=True),
     Column("user_answer_json", String(2000)),
     Column("correct", Boolean, default=False),
     Column("response_time_ms", Integer),
@@ -103,19 +158,61 @@ quiz_responses = Table(
 mastery = Table(
     "mastery",
     metadata,
-    Column("id", String(36), primary_key=True, default=_uuid),
-    Column("patient_id", String(36), nullable=False),
+    Column("id", String(32), primary_key=True, default=_uuid),
+    Column("patient_id", String(32), nullable=False),
     Column("item_type", String(20), nullable=False),
-    Column("item_id", String(36), nullable=False),
+    Column("item_id", String(32), nullable=False),
     Column("mastery_score", Float, default=0.0),
     Column("consecutive_correct", Integer, default=0),
     Column("consecutive_incorrect", Integer, default=0),
     Column("last_seen_at", DateTime),
     Column("next_due_at", DateTime),
+    UniqueConstraint("patient_id", "item_type", "item_id", name="uq_mastery_item"),
+)
+
+# uq_mastery_item already serves (patient_id, item_type, item_id) lookups
+Index("ix_mastery_due", mastery.c.patient_id, mastery.c.next_due_at)
+Index("ix_qr_created", quiz_responses.c.created_at)
+
+# statements reused by the read helpers; built once with named bind params
+_GET_PATIENT = select(patients).where(patients.c.id == bindparam("id"))
+_LIST_PATIENTS = select(patients)
+_GET_FAMILY_MEMBER = select(family_members).where(family_members.c.id == bindparam("id"))
+_LIST_FAMILY = select(family_members).where(family_members.c.patient_id == bindparam("pid"))
+_GET_KNOWLEDGE_ITEM = select(knowledge_items).where(knowledge_items.c.id == bindparam("id"))
+_LIST_KNOWLEDGE = select(knowledge_items).where(
+    knowledge_items.c.patient_id == bindparam("pid")
+)
+_LIST_KNOWLEDGE_BY_CATEGORY = _LIST_KNOWLEDGE.where(
+    knowledge_items.c.category == bindparam("category")
+)
+_GET_SESSION = select(quiz_sessions).where(quiz_sessions.c.id == bindparam("id"))
+_LIST_QUESTIONS = select(quiz_questions).where(
+    quiz_questions.c.session_id == bindparam("session_id")
+)
+_GET_MASTERY_ROW = select(mastery).where(
+    mastery.c.patient_id == bindparam("pid"),
+    mastery.c.item_type == bindparam("item_type"),
+    mastery.c.item_id == bindparam("item_id"),
+)
+# row-value IN is not portable (SQL Server lacks it), so match on item_id
+# and let the caller's (item_type, item_id) pairs disambiguate
+_LIST_MASTERY_FOR_ITEMS = select(mastery).where(
+    mastery.c.patient_id == bindparam("pid"),
+    mastery.c.item_id.in_(bindparam("item_ids", expanding=True)),
 )
 
 engine_cache: Optional[Engine] = None
 
+# patient profile, family and knowledge reads used by quiz generation, keyed by
+# patient_id; writes to any of them drop the patient's entry
+patient_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+_patient_cache_lock = threading.Lock()
+# bumped on every invalidation, so a read that raced a write is not cached
+_patient_generation: Dict[str, int] = {}
+_cache_generation = itertools.count(1)
+_cleared_at = 0
+
 
 def get_engine() -> Engine:
     """Create or return a cached SQLAlchemy engine."""
@@ -131,135 +228,267 @@ def get_engine() -> Engine:
             future=True,
             connect_args={"check_same_thread": False},
             poolclass=StaticPool,
+            json_serializer=json_dumps,
+            json_deserializer=json_loads,
         )
     else:
-        engine_cache = create_engine(conn_str, future=True)
+        engine_cache = create_engine(
+            conn_str,
+            future=True,
+            pool_size=int(os.getenv("SQL_POOL_SIZE", "20")),
+            max_overflow=int(os.getenv("SQL_MAX_OVERFLOW", "20")),
+            pool_pre_ping=True,
+            pool_recycle=1800,
+            json_serializer=json_dumps,
+            json_deserializer=json_loads,
+            **_driver_options(conn_str),
+        )
     return engine_cache
 
 
+def _driver_options(conn_str: str) -> Dict[str, Any]:
+    """Driver-specific flags that make executemany send batches, not single rows."""
+    url = make_url(conn_str)
+    backend, driver = url.get_backend_name(), url.get_driver_name()
+    if backend == "mssql" and driver == "pyodbc":
+        return {"fast_executemany": True}
+    if backend == "postgresql" and driver == "psycopg2":
+        return {
+            "executemany_mode": "values_plus_batch",
+            "insertmanyvalues_page_size": 1000,
+        }
+    return {}
+
+
 def create_tables(engine: Engine) -> None:
     metadata.create_all(engine)
+    _upgrade_schema(engine)
+
+
+def _upgrade_schema(engine: Engine) -> None:
+    """Apply schema changes that create_all skips on tables that already exist.
+
+    Every step checks the live schema first, so this is safe to run on each startup.
+    """
+    with engine.begin() as conn:
+        # inspect through this connection so reflection sees the steps below
+        insp = inspect(conn)
+        # quiz_questions.item_type (analytics groups by it)
+        if "item_type" not in {c["name"] for c in insp.get_columns("quiz_questions")}:
+            conn.execute(text("ALTER TABLE quiz_questions ADD item_type VARCHAR(50)"))
+            _backfill_question_item_types(conn)
+
+        # indexes declared since the table was first created
+        for table in metadata.sorted_tables:
+            existing = {ix["name"] for ix in insp.get_indexes(table.name)}
+            for ix in table.indexes:
+                if ix.name not in existing:
+                    ix.create(conn)
+
+        # uq_mastery_item (the mastery upsert's ON CONFLICT target)
+        key = ["patient_id", "item_type", "item_id"]
+        unique_keys = [ix["column_names"] for ix in insp.get_indexes("mastery") if ix["unique"]]
+        try:
+            unique_keys += [uc["column_names"] for uc in insp.get_unique_constraints("mastery")]
+        except NotImplementedError:  # mssql; its unique constraints show up as unique indexes
+            pass
+        if not any(sorted(cols) == sorted(key) for cols in unique_keys):
+            _dedupe_mastery(conn)
+            conn.execute(
+                text("CREATE UNIQUE INDEX uq_mastery_item ON mastery (patient_id, item_type, item_id)")
+            )
+
+
+def _backfill_question_item_types(conn: Connection, page_size: int = 1000) -> None:
+    """Copy item_type out of payload_json for questions stored before the column existed."""
+    # read the raw text: legacy payload_json columns are plain strings
+    page = (
+        select(quiz_questions.c.id, type_coerce(quiz_questions.c.payload_json, String))
+        .where(quiz_questions.c.item_type == None, quiz_questions.c.id > bindparam("after"))  # noqa: E711
+        .order_by(quiz_questions.c.id)
+        .limit(page_size)
+    )
+    fill = (
+        update(quiz_questions)
+        .where(quiz_questions.c.id == bindparam("qid"))
+        .values(item_type=bindparam("itype"))
+    )
+    after = ""
+    while True:
+        rows = conn.execute(page, {"after": after}).all()
+        if not rows:
+            break
+        updates = []
+        for qid, raw in rows:
+            try:
+                item_type = json_loads(raw).get("item_type")
+            except (TypeError, ValueError, AttributeError):  # unparseable or not an object
+                item_type = None
+            if item_type:
+                updates.append({"qid": qid, "itype": str(item_type)[:50]})
+        if updates:
+            conn.execute(fill, updates)
+        after = rows[-1][0]
+
+
+def _dedupe_mastery(conn: Connection) -> None:
+    """Keep the most recently seen row per item; the old read-then-write could race."""
+    key_cols = (mastery.c.patient_id, mastery.c.item_type, mastery.c.item_id)
+    dupes = conn.execute(
+        select(*key_cols).group_by(*key_cols).having(func.count() > 1)
+    ).all()
+    stale_ids = []
+    for patient_id, item_type, item_id in dupes:
+        rows = conn.execute(
+            select(mastery.c.id, mastery.c.last_seen_at).where(
+                mastery.c.patient_id == patient_id,
+                mastery.c.item_type == item_type,
+                mastery.c.item_id == item_id,
+            )
+        ).all()
+        keep = max(rows, key=lambda r: (r.last_seen_at or datetime.min, r.id))
+        stale_ids.extend(r.id for r in rows if r.id != keep.id)
+    if stale_ids:
+        conn.execute(mastery.delete().where(mastery.c.id.in_(stale_ids)))
 
 
 def _row_to_dict(row) -> dict:
-    if not row:
-        return None
-    mapping = row._mapping
-    return {k: mapping[k] for k in mapping.keys()}
+    return dict(row._mapping) if row else None
+
+
+def invalidate_patient_cache(patient_id: str) -> None:
+    with _patient_cache_lock:
+        patient_cache.pop(patient_id, None)
+        _patient_generation[patient_id] = next(_cache_generation)
+
+
+def clear_patient_cache() -> None:
+    global _cleared_at
+    with _patient_cache_lock:
+        patient_cache.clear()
+        _patient_generation.clear()
+        _cleared_at = next(_cache_generation)
+
+
+def _cache_token(patient_id: str) -> Tuple[int, int]:
+    return _patient_generation.get(patient_id, 0), _cleared_at
 
 
 def create_patient(engine: Engine, data: Dict[str, Any]) -> Dict[str, Any]:
-    patient_id = _uuid()
+    row = {"id": _uuid(), **data, "created_at": datetime.utcnow()}
     with engine.begin() as conn:
-        conn.execute(
-            patients.insert().values(
-                id=patient_id,
-                full_name=data["full_name"],
-                dob=data["dob"],
-                phone=data.get("phone"),
-                address=data.get("address"),
-                created_at=datetime.utcnow(),
-            )
-        )
-    return get_patient(engine, patient_id)
+        conn.execute(patients.insert().values(**row))
+    return row
 
 
 def get_patient(engine: Engine, patient_id: str) -> Optional[Dict[str, Any]]:
     with engine.connect() as conn:
-        row = conn.execute(select(patients).where(patients.c.id == patient_id)).first()
+        row = conn.execute(_GET_PATIENT, {"id": patient_id}).first()
         return _row_to_dict(row)
 
 
 def list_patients(engine: Engine) -> List[Dict[str, Any]]:
     with engine.connect() as conn:
-        rows = conn.execute(select(patients)).all()
+        rows = conn.execute(_LIST_PATIENTS).all()
         return [_row_to_dict(r) for r in rows]
 
 
 def add_family_member(engine: Engine, patient_id: str, data: Dict[str, Any]):
-    fam_id = _uuid()
+    row = {"id": _uuid(), "patient_id": patient_id, **data, "created_at": datetime.utcnow()}
     with engine.begin() as conn:
-        conn.execute(
-            family_members.insert().values(
-                id=fam_id,
-                patient_id=patient_id,
-                full_name=data["full_name"],
-                relationship=data["relationship"],
-                photo_blob_path=data.get("photo_blob_path"),
-                created_at=datetime.utcnow(),
-            )
-        )
-    return get_family_member(engine, fam_id)
+        conn.execute(family_members.insert().values(**row))
+    invalidate_patient_cache(patient_id)
+    return row
 
 
 def get_family_member(engine: Engine, family_id: str):
     with engine.connect() as conn:
-        row = conn.execute(
-            select(family_members).where(family_members.c.id == family_id)
-        ).first()
+        row = conn.execute(_GET_FAMILY_MEMBER, {"id": family_id}).first()
         return _row_to_dict(row)
 
 
-def update_family_photo(engine: Engine, family_id: str, blob_path: str):
+def update_family_photo(engine: Engine, patient_id: str, family_id: str, blob_path: str):
     with engine.begin() as conn:
         conn.execute(
             update(family_members)
-            .where(family_members.c.id == family_id)
+            .where(
+                family_members.c.id == family_id,
+                family_members.c.patient_id == patient_id,
+            )
             .values(photo_blob_path=blob_path)
         )
+    invalidate_patient_cache(patient_id)
 
 
 def list_family_members(engine: Engine, patient_id: str):
     with engine.connect() as conn:
-        rows = conn.execute(
-            select(family_members).where(family_members.c.patient_id == patient_id)
-        ).all()
+        rows = conn.execute(_LIST_FAMILY, {"pid": patient_id}).all()
         return [_row_to_dict(r) for r in rows]
 
 
 def add_knowledge_item(engine: Engine, patient_id: str, data: Dict[str, Any]):
-    item_id = _uuid()
+    row = {"id": _uuid(), "patient_id": patient_id, **data, "created_at": datetime.utcnow()}
     with engine.begin() as conn:
-        conn.execute(
-            knowledge_items.insert().values(
-                id=item_id,
-                patient_id=patient_id,
-                category=data["category"],
-                label=data["label"],
-                value=data["value"],
-                sensitivity_level=int(data.get("sensitivity_level", 0)),
-                is_active=data.get("is_active", True),
-                created_at=datetime.utcnow(),
-            )
-        )
-    return get_knowledge_item(engine, item_id)
+        conn.execute(knowledge_items.insert().values(**row))
+    invalidate_patient_cache(patient_id)
+    return row
 
 
 def get_knowledge_item(engine: Engine, item_id: str):
     with engine.connect() as conn:
-        row = conn.execute(
-            select(knowledge_items).where(knowledge_items.c.id == item_id)
-        ).first()
+        row = conn.execute(_GET_KNOWLEDGE_ITEM, {"id": item_id}).first()
         return _row_to_dict(row)
 
 
 def list_knowledge_items(engine: Engine, patient_id: str, category: Optional[str]):
-    stmt = select(knowledge_items).where(knowledge_items.c.patient_id == patient_id)
+    params = {"pid": patient_id}
+    stmt = _LIST_KNOWLEDGE
     if category:
-        stmt = stmt.where(knowledge_items.c.category == category)
+        stmt = _LIST_KNOWLEDGE_BY_CATEGORY
+        params["category"] = category
     with engine.connect() as conn:
-        rows = conn.execute(stmt).all()
+        rows = conn.execute(stmt, params).all()
         return [_row_to_dict(r) for r in rows]
 
 
-def create_session(engine: Engine, patient_id: str, total_questions: int, status: str):
+def quiz_context(
+    engine: Engine, patient_id: str
+) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]], List[Dict[str, Any]]]]:
+    """Return (patient, family_members, knowledge_items), cached briefly per patient."""
+    with _patient_cache_lock:
+        cached = patient_cache.get(patient_id)
+        token = _cache_token(patient_id)
+    if cached is not None:
+        return cached
+    patient = get_patient(engine, patient_id)
+    if not patient:
+        return None
+    context = (
+        patient,
+        list_family_members(engine, patient_id),
+        list_knowledge_items(engine, patient_id, None),
+    )
+    with _patient_cache_lock:
+        # skip the store if a write invalidated this patient while we were reading
+        if _cache_token(patient_id) == token:
+            patient_cache[patient_id] = context
+    return context
+
+
+def create_session(
+    engine: Engine,
+    patient_id: str,
+    total_questions: int,
+    status: str,
+    now: Optional[datetime] = None,
+):
     session_id = _uuid()
     with engine.begin() as conn:
         conn.execute(
             quiz_sessions.insert().values(
                 id=session_id,
                 patient_id=patient_id,
-                created_at=datetime.utcnow(),
+                created_at=now or datetime.utcnow(),
                 status=status,
                 total_questions=total_questions,
             )
@@ -269,91 +498,187 @@ def create_session(engine: Engine, patient_id: str, total_questions: int, status
 
 def get_session(engine: Engine, session_id: str):
     with engine.connect() as conn:
-        row = conn.execute(
-            select(quiz_sessions).where(quiz_sessions.c.id == session_id)
-        ).first()
+        row = conn.execute(_GET_SESSION, {"id": session_id}).first()
         return _row_to_dict(row)
 
 
-def add_question(
-    engine: Engine, session_id: str, question_type: str, payload_json: str, correct_answer_json: str
-) -> str:
-    question_id = _uuid()
-    with engine.begin() as conn:
-        conn.execute(
-            quiz_questions.insert().values(
-                id=question_id,
-                session_id=session_id,
-                question_type=question_type,
-                payload_json=payload_json,
-                correct_answer_json=correct_answer_json,
-                created_at=datetime.utcnow(),
-            )
-        )
-    return question_id
+def add_questions_bulk(
+    engine: Engine,
+    session_id: str,
+    questions: List[Dict[str, Any]],
+    now: Optional[datetime] = None,
+    question_ids: Optional[List[str]] = None,
+) -> List[str]:
+    """Insert all questions for a session in one executemany round-trip."""
+    now = now or datetime.utcnow()
+    if question_ids is None:
+        question_ids = [_uuid() for _ in questions]
+    rows = [
+        {
+            "id": question_id,
+            "session_id": session_id,
+            "question_type": q["question_type"],
+            "item_type": q.get("item_type"),
+            "payload_json": q,
+            "correct_answer_json": json_dumps(q.get("correct_answer")),
+            "created_at": now,
+        }
+        for question_id, q in zip(question_ids, questions)
+    ]
+    if rows:
+        with engine.begin() as conn:
+            conn.execute(quiz_questions.insert(), rows)
+    return [row["id"] for row in rows]
 
 
 def list_questions(engine: Engine, session_id: str):
     with engine.connect() as conn:
-        rows = conn.execute(
-            select(quiz_questions).where(quiz_questions.c.session_id == session_id)
-        ).all()
+        rows = conn.execute(_LIST_QUESTIONS, {"session_id": session_id}).all()
         return [_row_to_dict(r) for r in rows]
 
 
-def add_response(
+def _add_responses(
+    conn: Connection,
+    session_id: str,
+    rows: List[Dict[str, Any]],
+    now: Optional[datetime] = None,
+) -> None:
+    now = now or datetime.utcnow()
+    values = [
+        {
+            "id": _uuid(),
+            "session_id": session_id,
+            "question_id": row["question_id"],
+            "user_answer_json": row["user_answer_json"],
+            "correct": row["correct"],
+            "response_time_ms": row["response_time_ms"],
+            "created_at": now,
+        }
+        for row in rows
+    ]
+    if values:
+        conn.execute(quiz_responses.insert(), values)
+
+
+def add_responses_bulk(
     engine: Engine,
     session_id: str,
-    question_id: str,
-    user_answer_json: str,
-    correct: bool,
-    response_time_ms: int,
-):
+    rows: List[Dict[str, Any]],
+    now: Optional[datetime] = None,
+) -> None:
+    """Insert all graded responses for a session in one executemany round-trip."""
     with engine.begin() as conn:
-        conn.execute(
-            quiz_responses.insert().values(
-                id=_uuid(),
-                session_id=session_id,
-                question_id=question_id,
-                user_answer_json=user_answer_json,
-                correct=correct,
-                response_time_ms=response_time_ms,
-                created_at=datetime.utcnow(),
-            )
+        _add_responses(conn, session_id, rows, now=now)
+
+
+def _complete_session(
+    conn: Connection, session_id: str, score: float, avg_response_time_ms: float
+) -> None:
+    conn.execute(
+        update(quiz_sessions)
+        .where(quiz_sessions.c.id == session_id)
+        .values(
+            status="completed",
+            score=score,
+            avg_response_time_ms=avg_response_time_ms,
         )
+    )
 
 
 def complete_session(engine: Engine, session_id: str, score: float, avg_response_time_ms: float):
     with engine.begin() as conn:
-        conn.execute(
-            update(quiz_sessions)
-            .where(quiz_sessions.c.id == session_id)
-            .values(
-                status="completed",
-                score=score,
-                avg_response_time_ms=avg_response_time_ms,
-            )
-        )
+        _complete_session(conn, session_id, score, avg_response_time_ms)
+
+
+def _get_mastery_row(conn: Connection, patient_id: str, item_type: str, item_id: str):
+    row = conn.execute(
+        _GET_MASTERY_ROW, {"pid": patient_id, "item_type": item_type, "item_id": item_id}
+    ).first()
+    return _row_to_dict(row)
+
+
+def _get_mastery_rows(
+    conn: Connection, patient_id: str, pairs: Iterable[Tuple[str, str]]
+) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """Fetch mastery rows for many (item_type, item_id) pairs in one query."""
+    wanted = {pair for pair in pairs if all(pair)}
+    if not wanted:
+        return {}
+    rows = conn.execute(
+        _LIST_MASTERY_FOR_ITEMS,
+        {"pid": patient_id, "item_ids": sorted({item_id for _, item_id in wanted})},
+    )
+    found = {}
+    for row in rows:
+        key = (row.item_type, row.item_id)
+        if key in wanted:
+            found[key] = _row_to_dict(row)
+    return found
+
+
+_MASTERY_KEY = ("patient_id", "item_type", "item_id")
+_MASTERY_STATE = (
+    "mastery_score",
+    "consecutive_correct",
+    "consecutive_incorrect",
+    "last_seen_at",
+    "next_due_at",
+)
 
+_MSSQL_MASTERY_MERGE = text(
+    """
+    MERGE mastery WITH (HOLDLOCK) AS target
+    USING (VALUES (
+        :id, :patient_id, :item_type, :item_id, :mastery_score,
+        :consecutive_correct, :consecutive_incorrect, :last_seen_at, :next_due_at
+    )) AS source (
+        id, patient_id, item_type, item_id, mastery_score,
+        consecutive_correct, consecutive_incorrect, last_seen_at, next_due_at
+    )
+    ON target.patient_id = source.patient_id
+        AND target.item_type = source.item_type
+        AND target.item_id = source.item_id
+    WHEN MATCHED THEN UPDATE SET
+        mastery_score = source.mastery_score,
+        consecutive_correct = source.consecutive_correct,
+        consecutive_incorrect = source.consecutive_incorrect,
+        last_seen_at = source.last_seen_at,
+        next_due_at = source.next_due_at
+    WHEN NOT MATCHED THEN INSERT (
+        id, patient_id, item_type, item_id, mastery_score,
+        consecutive_correct, consecutive_incorrect, last_seen_at, next_due_at
+    ) VALUES (
+        source.id, source.patient_id, source.item_type, source.item_id,
+        source.mastery_score, source.consecutive_correct,
+        source.consecutive_incorrect, source.last_seen_at, source.next_due_at
+    );
+    """
+)
 
-def _get_mastery_row(engine: Engine, patient_id: str, item_type: str, item_id: str):
-    with engine.connect() as conn:
-        row = conn.execute(
-            select(mastery).where(
-                mastery.c.patient_id == patient_id,
-                mastery.c.item_type == item_type,
-                mastery.c.item_id == item_id,
-            )
-        ).first()
-        return _row_to_dict(row)
+_upsert_stmt_cache: Dict[str, Any] = {}
 
 
-def update_mastery(engine: Engine, payload: Dict[str, Any]):
-    existing = _get_mastery_row(
-        engine, payload["patient_id"], payload["item_type"], payload["item_id"]
-    )
-    now = datetime.utcnow()
-    values = {
+def _mastery_upsert_stmt(dialect_name: str):
+    """Return the dialect's single-statement mastery upsert, or None if unsupported."""
+    if dialect_name in _upsert_stmt_cache:
+        return _upsert_stmt_cache[dialect_name]
+    stmt = None
+    if dialect_name in ("postgresql", "sqlite"):
+        dialect_insert = postgresql.insert if dialect_name == "postgresql" else sqlite.insert
+        stmt = dialect_insert(mastery)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(_MASTERY_KEY),
+            set_={name: stmt.excluded[name] for name in _MASTERY_STATE},
+        )
+    elif dialect_name == "mssql":
+        stmt = _MSSQL_MASTERY_MERGE
+    _upsert_stmt_cache[dialect_name] = stmt
+    return stmt
+
+
+def _mastery_values(payload: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+    return {
+        "id": _uuid(),
         "patient_id": payload["patient_id"],
         "item_type": payload["item_type"],
         "item_id": payload["item_id"],
@@ -363,101 +688,140 @@ def update_mastery(engine: Engine, payload: Dict[str, Any]):
         "last_seen_at": payload.get("last_seen_at", now),
         "next_due_at": payload.get("next_due_at"),
     }
-    with engine.begin() as conn:
+
+
+def _upsert_mastery(conn: Connection, payloads: List[Dict[str, Any]]) -> None:
+    if not payloads:
+        return
+    now = datetime.utcnow()
+    rows = [_mastery_values(p, now) for p in payloads]
+    stmt = _mastery_upsert_stmt(conn.dialect.name)
+    if stmt is not None:
+        conn.execute(stmt, rows)
+        return
+    # no native upsert for this dialect: fall back to read-then-write per row
+    for values in rows:
+        existing = _get_mastery_row(
+            conn, values["patient_id"], values["item_type"], values["item_id"]
+        )
         if existing:
+            values.pop("id")
             conn.execute(
-                update(mastery)
-                .where(mastery.c.id == existing["id"])
-                .values(**values)
+                update(mastery).where(mastery.c.id == existing["id"]).values(**values)
             )
         else:
-            values["id"] = _uuid()
             conn.execute(mastery.insert().values(**values))
 
 
+def update_mastery(engine: Engine, payload: Dict[str, Any]):
+    with engine.begin() as conn:
+        _upsert_mastery(conn, [payload])
+
+
+def upsert_mastery_bulk(engine: Engine, payloads: List[Dict[str, Any]]) -> None:
+    """Insert or update many mastery rows in a single statement where supported."""
+    with engine.begin() as conn:
+        _upsert_mastery(conn, payloads)
+
+
+_MASTERY_IS_DUE = (mastery.c.next_due_at == None) | (  # noqa: E711
+    mastery.c.next_due_at <= bindparam("now")
+)
+
+# only the fields consumers read; due rows are serialised into the LLM prompt
+_DUE_MASTERY = select(
+    mastery.c.item_type,
+    mastery.c.item_id,
+    mastery.c.next_due_at,
+    mastery.c.last_seen_at,
+).where(mastery.c.patient_id == bindparam("pid"), _MASTERY_IS_DUE)
+
+
+def _unscheduled_select(item_table: Table, item_type: str, sensitivity_level):
+    """Items of one table with no due mastery row (never seen, or not due yet)."""
+    due_row = (
+        select(mastery.c.id)
+        .where(
+            mastery.c.patient_id == bindparam("pid"),
+            mastery.c.item_id == item_table.c.id,
+            _MASTERY_IS_DUE,
+        )
+        .exists()
+    )
+    return select(
+        literal(item_type).label("item_type"),
+        item_table.c.id.label("item_id"),
+        sensitivity_level.label("sensitivity_level"),
+    ).where(item_table.c.patient_id == bindparam("pid"), ~due_row)
+
+
+_UNSCHEDULED_ITEMS = union_all(
+    _unscheduled_select(family_members, "family", cast(null(), Integer)),
+    _unscheduled_select(knowledge_items, "knowledge", knowledge_items.c.sensitivity_level),
+)
+
+
 def due_items(engine: Engine, patient_id: str):
     """Return items due for review, including ones missing mastery rows."""
-    now = datetime.utcnow()
+    params = {"pid": patient_id, "now": datetime.utcnow()}
     with engine.connect() as conn:
-        # existing mastery rows due now
-        mastery_rows = conn.execute(
-            select(mastery).where(
-                mastery.c.patient_id == patient_id,
-                (mastery.c.next_due_at == None) | (mastery.c.next_due_at <= now),  # noqa: E711
-            )
-        ).all()
-        due_list = [_row_to_dict(r) for r in mastery_rows]
+        due_list = [_row_to_dict(r) for r in conn.execute(_DUE_MASTERY, params)]
+        # the rest are listed as unseen: family first, then knowledge
+        rest = sorted(
+            conn.execute(_UNSCHEDULED_ITEMS, params), key=lambda r: r.item_type != "family"
+        )
+    for row in rest:
+        item = {"item_type": row.item_type, "item_id": row.item_id}
+        if row.item_type == "knowledge":
+            item["sensitivity_level"] = row.sensitivity_level
+        item["next_due_at"] = None
+        item["last_seen_at"] = None
+        due_list.append(item)
+    return due_list
 
-        # find knowledge/family items without mastery rows
-        known_ids = {row["item_id"] for row in due_list}
-        family_rows = conn.execute(
-            select(family_members.c.id).where(family_members.c.patient_id == patient_id)
-        ).all()
-        knowledge_rows = conn.execute(
-            select(knowledge_items.c.id, knowledge_items.c.sensitivity_level).where(
-                knowledge_items.c.patient_id == patient_id
-            )
-        ).all()
 
-        for row in family_rows:
-            if row.id not in known_ids:  # type: ignore
-                due_list.append(
-                    {
-                        "item_type": "family",
-                        "item_id": row.id,  # type: ignore
-                        "next_due_at": None,
-                        "last_seen_at": None,
-                    }
-                )
-                known_ids.add(row.id)  # type: ignore
-
-        for row in knowledge_rows:
-            if row.id not in known_ids:  # type: ignore
-                due_list.append(
-                    {
-                        "item_type": "knowledge",
-                        "item_id": row.id,  # type: ignore
-                        "sensitivity_level": row.sensitivity_level,  # type: ignore
-                        "next_due_at": None,
-                        "last_seen_at": None,
-                    }
-                )
-                known_ids.add(row.id)  # type: ignore
-    return due_list
+_ACCURACY_BY_ITEM_TYPE = (
+    select(
+        quiz_questions.c.item_type,
+        func.sum(
+            case((quiz_responses.c.correct == True, 1), else_=0)  # noqa: E712
+        ).label("correct"),
+        func.count().label("total"),
+    )
+    .select_from(
+        quiz_questions.join(
+            quiz_responses, quiz_questions.c.id == quiz_responses.c.question_id
+        )
+    )
+    .where(quiz_responses.c.created_at >= bindparam("cutoff"))
+    .group_by(quiz_questions.c.item_type)
+)
+
+_MASTERY_SCHEDULE = (
+    select(
+        mastery.c.item_type,
+        mastery.c.item_id,
+        mastery.c.last_seen_at,
+        mastery.c.next_due_at,
+    )
+    .where(mastery.c.patient_id == bindparam("pid"))
+    .execution_options(yield_per=1000)
+)
 
 
 def analytics_summary(engine: Engine, patient_id: str, days: int = 30) -> Dict[str, Any]:
     cutoff = datetime.utcnow() - timedelta(days=days)
     data = {"accuracy_by_category": {}, "last_seen": {}, "next_due": {}}
     with engine.connect() as conn:
-        # accuracy by category from quiz_responses joined with questions
-        rows = conn.execute(
-            select(
-                quiz_questions.c.id,
-                quiz_questions.c.payload_json,
-                quiz_responses.c.correct,
-            ).join(
-                quiz_responses, quiz_questions.c.id == quiz_responses.c.question_id
-            ).where(
-                quiz_responses.c.created_at >= cutoff
-            )
-        ).all()
-        stats = {}
+        # accuracy by category, aggregated in SQL over the question's item_type
+        rows = conn.execute(_ACCURACY_BY_ITEM_TYPE, {"cutoff": cutoff}).all()
         for r in rows:
-            payload = json.loads(r.payload_json)
-            category = payload.get("item_type", "unknown")
-            stat = stats.setdefault(category, {"correct": 0, "total": 0})
-            stat["total"] += 1
-            if r.correct:
-                stat["correct"] += 1
-        for category, stat in stats.items():
-            data["accuracy_by_category"][category] = stat["correct"] / max(
-                stat["total"], 1
+            data["accuracy_by_category"][r.item_type or "unknown"] = (r.correct or 0) / max(
+                r.total, 1
             )
-        # last seen / next due from mastery
-        mrows = conn.execute(
-            select(mastery).where(mastery.c.patient_id == patient_id)
-        ).all()
+        # last seen / next due from mastery, streamed in chunks rather than
+        # materialised up front
+        mrows = conn.execute(_MASTERY_SCHEDULE, {"pid": patient_id})
         for r in mrows:
             key = f"{r.item_type}:{r.item_id}"
             data["last_seen"][key] = (
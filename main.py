@@ -1,12 +1,14 @@
 """Main FastAPI application for the cognitive-reinforcement-backend."""
 from __future__ import annotations
 
-import json
+import hmac
 import os
 from datetime import datetime
 from typing import Annotated, List, Optional
 
+import anyio
 from fastapi import (
+    BackgroundTasks,
     Body,
     Depends,
     FastAPI,
@@ -15,7 +17,8 @@ from fastapi import (
     HTTPException,
     UploadFile,
 )
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
@@ -27,6 +30,7 @@ import storage
 load_dotenv()
 
 API_KEY = os.getenv("APP_API_KEY")
+_API_KEY_BYTES = API_KEY.encode() if API_KEY else None
 
 app = FastAPI(title="cognitive-reinforcement-backend")
 app.add_middleware(
@@ -38,9 +42,8 @@ app.add_middleware(
 
 
 async def verify_api_key(x_api_key: Annotated[Optional[str], Header()] = None):
-    if not API_KEY:
-        raise HTTPException(status_code=500, detail="Server missing APP_API_KEY")
-    if x_api_key != API_KEY:
+    # APP_API_KEY presence is checked once at startup
+    if not hmac.compare_digest((x_api_key or "").encode(), _API_KEY_BYTES):
         raise HTTPException(status_code=401, detail="Invalid API key")
     return True
 
@@ -50,10 +53,24 @@ AuthDependency = Depends(verify_api_key)
 
 @app.on_event("startup")
 def _startup():
+    if not API_KEY:
+        raise RuntimeError("APP_API_KEY is not configured")
     engine = db.get_engine()
     db.create_tables(engine)
 
 
+@app.on_event("startup")
+async def _configure_threadpool():
+    # sync endpoints run on AnyIO worker threads, capped at 40 by default
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = int(os.getenv("APP_THREADPOOL_SIZE", "100"))
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await storage.close_blob_client()
+
+
 class PatientCreate(BaseModel):
     full_name: str
     dob: str
@@ -111,6 +128,21 @@ class QuizGenerateResponse(BaseModel):
     questions: List[QuizQuestionResponse]
 
 
+def _question_response(
+    question_id: str, q: dict, reveal_answers: bool
+) -> QuizQuestionResponse:
+    return QuizQuestionResponse(
+        question_id=question_id,
+        question_type=q["question_type"],
+        prompt=q["prompt"],
+        options=q.get("options"),
+        item_type=q["item_type"],
+        item_id=q["item_id"],
+        difficulty=q["difficulty"],
+        acceptable_answers=q.get("acceptable_answers") if reveal_answers else None,
+    )
+
+
 class QuizSubmitItem(BaseModel):
     question_id: str
     user_answer: str | int | bool | dict | list
@@ -139,7 +171,7 @@ def health():
 
 @app.post("/patients", dependencies=[AuthDependency], response_model=PatientResponse)
 def create_patient(payload: PatientCreate):
-    return db.create_patient(db.get_engine(), payload.dict())
+    return db.create_patient(db.get_engine(), payload.model_dump())
 
 
 @app.get("/patients", dependencies=[AuthDependency], response_model=List[PatientResponse])
@@ -165,7 +197,7 @@ def get_patient(patient_id: str):
     response_model=FamilyMemberResponse,
 )
 def add_family_member(patient_id: str, payload: FamilyMemberCreate):
-    return db.add_family_member(db.get_engine(), patient_id, payload.dict())
+    return db.add_family_member(db.get_engine(), patient_id, payload.model_dump())
 
 
 @app.get(
@@ -185,7 +217,9 @@ async def upload_family_photo(
     patient_id: str, family_id: str, file: UploadFile = File(...)
 ):
     blob_path = await storage.upload_family_photo(patient_id, family_id, file)
-    db.update_family_photo(db.get_engine(), family_id, blob_path)
+    await run_in_threadpool(
+        db.update_family_photo, db.get_engine(), patient_id, family_id, blob_path
+    )
     return {"blob_path": blob_path}
 
 
@@ -195,7 +229,7 @@ async def upload_family_photo(
     response_model=KnowledgeItemResponse,
 )
 def add_knowledge_item(patient_id: str, payload: KnowledgeItemCreate):
-    return db.add_knowledge_item(db.get_engine(), patient_id, payload.dict())
+    return db.add_knowledge_item(db.get_engine(), patient_id, payload.model_dump())
 
 
 @app.get(
@@ -211,8 +245,10 @@ def list_knowledge_items(patient_id: str, category: Optional[str] = None):
     "/patients/{patient_id}/uploads",
     dependencies=[AuthDependency],
 )
-async def upload_patient_doc(patient_id: str, file: UploadFile = File(...)):
-    blob_path = await storage.upload_patient_document(patient_id, file)
+async def upload_patient_doc(
+    patient_id: str, background_tasks: BackgroundTasks, file: UploadFile = File(...)
+):
+    blob_path = await storage.upload_patient_document(patient_id, file, background_tasks)
     return {"blob_path": blob_path}
 
 
@@ -221,20 +257,20 @@ async def upload_patient_doc(patient_id: str, file: UploadFile = File(...)):
     dependencies=[AuthDependency],
     response_model=QuizGenerateResponse,
 )
-def generate_quiz(
+async def generate_quiz(
     patient_id: str,
     n: int = 7,
     include_sensitive: bool = False,
     reveal_answers: bool = False,
 ):
+    # DB helpers are sync, so they run on the threadpool while the LLM call is awaited
     engine = db.get_engine()
-    patient = db.get_patient(engine, patient_id)
-    if not patient:
+    context = await run_in_threadpool(db.quiz_context, engine, patient_id)
+    if not context:
         raise HTTPException(status_code=404, detail="Patient not found")
-    family_members = db.list_family_members(engine, patient_id)
-    knowledge_items = db.list_knowledge_items(engine, patient_id, None)
-    due_items = db.due_items(engine, patient_id)
-    questions = quiz.generate_quiz_questions(
+    patient, family_members, knowledge_items = context
+    due_items = await run_in_threadpool(db.due_items, engine, patient_id)
+    questions = await quiz.agenerate_quiz_questions(
         patient=patient,
         family_members=family_members,
         knowledge_items=knowledge_items,
@@ -242,34 +278,85 @@ def generate_quiz(
         n=n,
         include_sensitive=include_sensitive,
     )
-    session_id = db.create_session(
-        engine, patient_id, total_questions=len(questions), status="active"
-    )
-    response_questions = []
     for q in questions:
-        question_id = db.add_question(
+        quiz.prepare_question(q)
+    now = datetime.utcnow()
+    session_id = await run_in_threadpool(
+        db.create_session,
+        engine,
+        patient_id,
+        total_questions=len(questions),
+        status="active",
+        now=now,
+    )
+    question_ids = await run_in_threadpool(
+        db.add_questions_bulk, engine, session_id, questions, now=now
+    )
+    response_questions = [
+        _question_response(question_id, q, reveal_answers)
+        for question_id, q in zip(question_ids, questions)
+    ]
+    return QuizGenerateResponse(session_id=session_id, questions=response_questions)
+
+
+@app.post(
+    "/patients/{patient_id}/quiz/generate/stream",
+    dependencies=[AuthDependency],
+)
+async def generate_quiz_stream(
+    patient_id: str,
+    n: int = 7,
+    include_sensitive: bool = False,
+    reveal_answers: bool = False,
+):
+    """NDJSON: one question per line as the LLM produces it, then a session_id line.
+
+    The session is saved once every question has been sent, so answers can be
+    submitted after the final line arrives.
+    """
+    engine = db.get_engine()
+    context = await run_in_threadpool(db.quiz_context, engine, patient_id)
+    if not context:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    patient, family_members, knowledge_items = context
+    due_items = await run_in_threadpool(db.due_items, engine, patient_id)
+
+    async def lines():
+        questions = []
+        question_ids = []
+        async for q in quiz.astream_quiz_questions(
+            patient=patient,
+            family_members=family_members,
+            knowledge_items=knowledge_items,
+            due_items=due_items,
+            n=n,
+            include_sensitive=include_sensitive,
+        ):
+            quiz.prepare_question(q)
+            question_id = db._uuid()
+            questions.append(q)
+            question_ids.append(question_id)
+            yield _question_response(question_id, q, reveal_answers).model_dump_json() + "\n"
+        now = datetime.utcnow()
+        session_id = await run_in_threadpool(
+            db.create_session,
             engine,
-            session_id,
-            question_type=q["question_type"],
-            payload_json=json.dumps(q),
-            correct_answer_json=json.dumps(q.get("correct_answer")),
+            patient_id,
+            total_questions=len(questions),
+            status="active",
+            now=now,
         )
-        response_questions.append(
-            QuizQuestionResponse(
-                question_id=question_id,
-                question_type=q["question_type"],
-                prompt=q["prompt"],
-                options=q.get("options"),
-                item_type=q["item_type"],
-                item_id=q["item_id"],
-                difficulty=q["difficulty"],
-                acceptable_answers=q.get("acceptable_answers"),
-            )
+        await run_in_threadpool(
+            db.add_questions_bulk,
+            engine,
+            session_id,
+            questions,
+            now=now,
+            question_ids=question_ids,
         )
-    if not reveal_answers:
-        for idx, item in enumerate(response_questions):
-            response_questions[idx].acceptable_answers = None
-    return QuizGenerateResponse(session_id=session_id, questions=response_questions)
+        yield db.json_dumps({"session_id": session_id}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 @app.post(
@@ -286,43 +373,53 @@ def submit_quiz(
         raise HTTPException(status_code=404, detail="Session not found")
     questions = db.list_questions(engine, session_id)
     qmap = {q["id"]: q for q in questions}
+    now = datetime.utcnow()
     results = []
+    response_rows = []
+    graded = []
     correct_count = 0
     total_time = 0
-    for item in submissions:
-        question = qmap.get(item.question_id)
-        if not question:
-            raise HTTPException(status_code=400, detail="Invalid question id")
-        payload = json.loads(question["payload_json"])
-        correct_answer = payload.get("correct_answer")
-        acceptable_answers = payload.get("acceptable_answers") or []
-        is_correct = quiz.evaluate_answer(
-            payload["question_type"], correct_answer, item.user_answer, acceptable_answers
+    with engine.begin() as conn:
+        stored_mastery = db._get_mastery_rows(
+            conn,
+            session["patient_id"],
+            {
+                (q["payload_json"].get("item_type"), q["payload_json"].get("item_id"))
+                for q in questions
+            },
         )
-        if is_correct:
-            correct_count += 1
-        total_time += item.response_time_ms
-        db.add_response(
-            engine,
-            session_id=session_id,
-            question_id=item.question_id,
-            user_answer_json=json.dumps(item.user_answer),
-            correct=is_correct,
-            response_time_ms=item.response_time_ms,
-        )
-        mastery_update = quiz.compute_mastery_update(
-            engine,
-            patient_id=session["patient_id"],
-            payload=payload,
-            correct=is_correct,
-            response_time_ms=item.response_time_ms,
+        for item in submissions:
+            question = qmap.get(item.question_id)
+            if not question:
+                raise HTTPException(status_code=400, detail="Invalid question id")
+            payload = question["payload_json"]
+            is_correct = quiz.evaluate_answer(
+                payload["question_type"],
+                item.user_answer,
+                expected_norm=quiz.correct_norm(payload),
+                acceptable_answers=quiz.acceptable_set(payload),
+            )
+            if is_correct:
+                correct_count += 1
+            total_time += item.response_time_ms
+            response_rows.append(
+                {
+                    "question_id": item.question_id,
+                    "user_answer_json": db.json_dumps(item.user_answer),
+                    "correct": is_correct,
+                    "response_time_ms": item.response_time_ms,
+                }
+            )
+            graded.append((payload, is_correct, item.response_time_ms))
+            results.append({"question_id": item.question_id, "correct": is_correct})
+        score = correct_count / max(len(submissions), 1)
+        avg_time = total_time / max(len(submissions), 1)
+        db._add_responses(conn, session_id, response_rows, now=now)
+        mastery_updates = quiz.compute_mastery_updates(
+            session["patient_id"], graded, stored_mastery, now=now
         )
-        if mastery_update:
-            db.update_mastery(engine, mastery_update)
-        results.append({"question_id": item.question_id, "correct": is_correct})
-    score = correct_count / max(len(submissions), 1)
-    avg_time = total_time / max(len(submissions), 1)
-    db.complete_session(engine, session_id, score=score, avg_response_time_ms=avg_time)
+        db._upsert_mastery(conn, mastery_updates)
+        db._complete_session(conn, session_id, score=score, avg_response_time_ms=avg_time)
     weak_items = [
         r["question_id"] for r in results if not r["correct"]
     ]
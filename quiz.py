@@ -1,184 +1,379 @@
 """Quiz generation and mastery logic."""
 from __future__ import annotations
 
-import json
+import asyncio
+import bisect
+import functools
 import os
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, TYPE_CHECKING, Set
+from itertools import chain
+from typing import AbstractSet, Any, AsyncIterator, Dict, FrozenSet, Iterable, List, Optional, Tuple
 from uuid import uuid4
 
 from dotenv import load_dotenv
 
 import db
 
-if TYPE_CHECKING:  # pragma: no cover
-    from openai import AzureOpenAI, OpenAIError  # type: ignore
+try:
+    from openai import AsyncAzureOpenAI, OpenAIError  # type: ignore
+except ImportError:  # pragma: no cover
+    AsyncAzureOpenAI = None  # type: ignore
+    OpenAIError = Exception  # type: ignore
 
 load_dotenv()
 
+_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
 
-def _client() -> Optional[AzureOpenAI]:
-    try:
-        from openai import AzureOpenAI  # type: ignore
-    except ImportError:
+
+def _build_client(client_cls):
+    if client_cls is None:
         return None
     endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
     key = os.getenv("AZURE_OPENAI_KEY")
-    deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-    if not endpoint or not key or not deployment:
+    if not endpoint or not key or not _DEPLOYMENT:
         return None
-    return AzureOpenAI(
+    return client_cls(
         api_version="2024-02-01",
         azure_endpoint=endpoint,
         api_key=key,
     )
 
 
+@functools.lru_cache(maxsize=1)
+def _async_client() -> Optional[AsyncAzureOpenAI]:
+    """Return the shared client, built on first use."""
+    return _build_client(AsyncAzureOpenAI)
+
+
+# both JSONDecodeErrors subclass ValueError
+_LLM_ERRORS = (OpenAIError, ValueError)
+
+
+def _completion_kwargs(messages: List[Dict[str, str]], **extra: Any) -> Dict[str, Any]:
+    return {
+        "model": _DEPLOYMENT,
+        "messages": messages,
+        "temperature": 0.2,
+        "max_tokens": 1200,
+        **extra,
+    }
+
+
+def reset_client() -> None:
+    """Drop the cached client and re-read the deployment name from the environment."""
+    global _DEPLOYMENT
+    _DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+    _async_client.cache_clear()
+
+
+# review interval grows with mastery: below 0.2 -> 1 day, ..., 0.8 and up -> 14 days
+_THRESH = (0.2, 0.4, 0.6, 0.8)
+_DAYS = (1, 2, 4, 7, 14)
+
+
 def _interval_days(score: float) -> int:
-    if score >= 0.8:
-        return 14
-    if score >= 0.6:
-        return 7
-    if score >= 0.4:
-        return 4
-    if score >= 0.2:
-        return 2
-    return 1
+    return _DAYS[bisect.bisect_right(_THRESH, score)]
+
+
+@functools.lru_cache(maxsize=512)
+def _template(item_id: str, label: Any, value: Any, item_type: str) -> Tuple[Tuple[str, Any], ...]:
+    return (
+        ("question_type", "mcq"),
+        ("prompt", f"Who/What is {label}?"),
+        ("correct_answer", value),
+        ("item_type", item_type),
+        ("item_id", item_id),
+        ("difficulty", 1),
+    )
 
 
 def _fallback_questions(knowledge_items, family_members, n: int) -> List[Dict[str, Any]]:
     items = (knowledge_items + family_members)[:n]
     questions = []
     for item in items:
+        value = item.get("value") or item.get("full_name")
+        template = _template(
+            item["id"],
+            item.get("label") or item.get("full_name"),
+            value,
+            "knowledge" if "label" in item else "family",
+        )
+        # lists are mutable, so options/acceptable_answers are built per question
         questions.append(
             {
-                "id": str(uuid4()),
-                "question_type": "mcq",
-                "prompt": f"Who/What is {item.get('label') or item.get('full_name')}?",
-                "options": [item.get("value") or item.get("full_name"), "Not sure"],
-                "correct_answer": item.get("value") or item.get("full_name"),
-                "item_type": "knowledge" if "label" in item else "family",
-                "item_id": item["id"],
-                "difficulty": 1,
+                "id": uuid4().hex,
+                **dict(template),
+                "options": [value, "Not sure"],
                 "acceptable_answers": [],
             }
         )
     return questions
 
 
-def generate_quiz_questions(
-    patient: Dict[str, Any],
+def _select_items(
     family_members: List[Dict[str, Any]],
     knowledge_items: List[Dict[str, Any]],
     due_items: List[Dict[str, Any]],
-    n: int = 7,
-    include_sensitive: bool = False,
-) -> List[Dict[str, Any]]:
-    sensitive_filtered = [
-        ki
-        for ki in knowledge_items
-        if include_sensitive or int(ki.get("sensitivity_level", 0)) < 2
-    ]
-    selected_items: List[Dict[str, Any]] = []
-    knowledge_lookup = {k["id"]: k for k in sensitive_filtered}
-    family_lookup = {f["id"]: f for f in family_members}
-    seen: Set[str] = set()
+    n: int,
+    include_sensitive: bool,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Return (knowledge items allowed in the prompt, items to quiz on)."""
+    # sensitivity_level is an Integer column, so rows need no int() cast
+    sensitive_filtered = (
+        knowledge_items
+        if include_sensitive
+        else [ki for ki in knowledge_items if (ki.get("sensitivity_level") or 0) < 2]
+    )
+    # insertion-ordered, so one dict both dedupes and keeps due items first
+    selected: Dict[str, Dict[str, Any]] = {}
+    # ids are UUIDs, so knowledge and family items share one lookup
+    id_lookup = {item["id"]: item for item in chain(sensitive_filtered, family_members)}
 
     # prioritize due items
     for due in due_items:
-        item = None
-        if due.get("item_type") == "knowledge":
-            item = knowledge_lookup.get(due.get("item_id"))
-        elif due.get("item_type") == "family":
-            item = family_lookup.get(due.get("item_id"))
-        if item and item["id"] not in seen:
-            selected_items.append(item)
-            seen.add(item["id"])
+        if len(selected) >= n:
+            break
+        item = id_lookup.get(due.get("item_id"))
+        if item:
+            selected.setdefault(item["id"], item)
 
     # fill remaining slots
-    for item in sensitive_filtered + family_members:
-        if item["id"] in seen:
-            continue
-        selected_items.append(item)
-        seen.add(item["id"])
-        if len(selected_items) >= n:
+    for item in chain(sensitive_filtered, family_members):
+        if len(selected) >= n:
             break
+        selected.setdefault(item["id"], item)
 
-    items_pool = selected_items[:n]
-    client = _client()
-    deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-    if not client or not deployment:
-        return _fallback_questions(items_pool, [], n)
-    try:
-        from openai import OpenAIError  # type: ignore
-    except ImportError:  # pragma: no cover
-        OpenAIError = Exception  # type: ignore
-    prompt = (
-        "You are generating gentle quiz questions for dementia care. "
-        "Use ONLY provided facts. Respond with JSON matching the schema: "
-        '{"questions":[{"question_type":"mcq|recall|photo_identity|true_false",'
-        '"prompt":"string","options":["string"...],"correct_answer":"string|number|boolean",'
-        '"item_type":"knowledge|family","item_id":"uuid","difficulty":1,"acceptable_answers":["string"...]}]}'
-    )
-    messages = [
-        {
-            "role": "system",
-            "content": prompt,
-        },
+    return sensitive_filtered, list(selected.values())
+
+
+_SYSTEM_PROMPT = (
+    "You are generating gentle quiz questions for dementia care. "
+    "Use ONLY provided facts. Respond with JSON matching the schema: "
+    '{"questions":[{"question_type":"mcq|recall|photo_identity|true_false",'
+    '"prompt":"string","options":["string"...],"correct_answer":"string|number|boolean",'
+    '"item_type":"knowledge|family","item_id":"uuid","difficulty":1,"acceptable_answers":["string"...]}]}'
+)
+_SYSTEM_MSG = {"role": "system", "content": _SYSTEM_PROMPT}
+
+
+def _messages(
+    patient: Dict[str, Any],
+    family_members: List[Dict[str, Any]],
+    knowledge_items: List[Dict[str, Any]],
+    due_items: List[Dict[str, Any]],
+    n: int,
+) -> List[Dict[str, str]]:
+    return [
+        _SYSTEM_MSG,
         {
             "role": "user",
-            "content": json.dumps(
+            "content": db.json_dumps(
                 {
                     "patient": {"full_name": patient.get("full_name")},
                     "family_members": family_members,
-                    "knowledge_items": sensitive_filtered,
+                    "knowledge_items": knowledge_items,
                     "due_items": due_items,
                     "n": n,
                 }
             ),
         },
     ]
+
+
+def generate_quiz_questions(
+    patient: Dict[str, Any],
+    family_members: List[Dict[str, Any]],
+    knowledge_items: List[Dict[str, Any]],
+    due_items: List[Dict[str, Any]],
+    n: int = 7,
+    include_sensitive: bool = False,
+) -> List[Dict[str, Any]]:
+    """Blocking wrapper for scripts and tests; not callable from a running event loop."""
+
+    async def run() -> List[Dict[str, Any]]:
+        # the shared client's connection pool belongs to the app's loop, and
+        # asyncio.run makes a new loop per call, so use a client scoped to this one
+        client = _build_client(AsyncAzureOpenAI)
+        if client is None:
+            return await _agenerate(None, *args)
+        async with client:
+            return await _agenerate(client, *args)
+
+    args = (patient, family_members, knowledge_items, due_items, n, include_sensitive)
+    return asyncio.run(run())
+
+
+async def agenerate_quiz_questions(
+    patient: Dict[str, Any],
+    family_members: List[Dict[str, Any]],
+    knowledge_items: List[Dict[str, Any]],
+    due_items: List[Dict[str, Any]],
+    n: int = 7,
+    include_sensitive: bool = False,
+) -> List[Dict[str, Any]]:
+    """Generate questions with the LLM, falling back to templates without it."""
+    return await _agenerate(
+        _async_client(), patient, family_members, knowledge_items, due_items, n, include_sensitive
+    )
+
+
+async def _agenerate(
+    client: Optional[AsyncAzureOpenAI],
+    patient: Dict[str, Any],
+    family_members: List[Dict[str, Any]],
+    knowledge_items: List[Dict[str, Any]],
+    due_items: List[Dict[str, Any]],
+    n: int,
+    include_sensitive: bool,
+) -> List[Dict[str, Any]]:
+    sensitive_filtered, items_pool = _select_items(
+        family_members, knowledge_items, due_items, n, include_sensitive
+    )
+    if not client:
+        return _fallback_questions(items_pool, [], n)
+    messages = _messages(patient, family_members, sensitive_filtered, due_items, n)
     try:
-        resp = client.chat.completions.create(
-            model=deployment,
-            messages=messages,
-            temperature=0.2,
-            max_tokens=1200,
-        )
+        resp = await client.chat.completions.create(**_completion_kwargs(messages))
         content = resp.choices[0].message.content
-        data = json.loads(content)
+        data = db.json_loads(content)
         return data.get("questions", [])
-    except (OpenAIError, json.JSONDecodeError):
+    except _LLM_ERRORS:
         return _fallback_questions(items_pool, [], n)
 
 
+class _QuestionStreamParser:
+    """Incrementally pull question objects out of a streamed {"questions": [...]} reply."""
+
+    def __init__(self) -> None:
+        self._buf = ""
+        self._pos = 0
+        self._depth = 0
+        self._start: Optional[int] = None
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        self._buf += text
+        found = []
+        buf = self._buf
+        for i in range(self._pos, len(buf)):
+            ch = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+                # depth 1 is the outer object, 2 the questions array
+                if ch == "{" and self._depth == 3:
+                    self._start = i
+            elif ch in "}]":
+                self._depth -= 1
+                if ch == "}" and self._depth == 2 and self._start is not None:
+                    found.append(db.json_loads(buf[self._start : i + 1]))
+                    self._start = None
+        # keep only the unfinished question in the buffer
+        keep = self._start if self._start is not None else len(buf)
+        self._buf = buf[keep:]
+        self._pos = len(buf) - keep
+        if self._start is not None:
+            self._start = 0
+        return found
+
+
+async def astream_quiz_questions(
+    patient: Dict[str, Any],
+    family_members: List[Dict[str, Any]],
+    knowledge_items: List[Dict[str, Any]],
+    due_items: List[Dict[str, Any]],
+    n: int = 7,
+    include_sensitive: bool = False,
+) -> AsyncIterator[Dict[str, Any]]:
+    """Yield questions as the LLM streams them instead of waiting for the full reply."""
+    sensitive_filtered, items_pool = _select_items(
+        family_members, knowledge_items, due_items, n, include_sensitive
+    )
+    client = _async_client()
+    yielded = 0
+    if client:
+        messages = _messages(patient, family_members, sensitive_filtered, due_items, n)
+        parser = _QuestionStreamParser()
+        try:
+            stream = await client.chat.completions.create(
+                **_completion_kwargs(messages, stream=True)
+            )
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                for question in parser.feed(chunk.choices[0].delta.content):
+                    yielded += 1
+                    yield question
+        except _LLM_ERRORS:
+            pass
+    # questions already sent can't be taken back, so only fall back if none were
+    if not yielded:
+        for question in _fallback_questions(items_pool, [], n):
+            yield question
+
+
+def _normalize(answer: Any) -> str:
+    return str(answer).strip().lower()
+
+
+def prepare_question(question: Dict[str, Any]) -> Dict[str, Any]:
+    """Store normalized answers on the payload so grading only normalizes the user's."""
+    question["correct_answer_norm"] = _normalize(question.get("correct_answer"))
+    question["acceptable_answers_lower"] = sorted(
+        {str(a).lower() for a in question.get("acceptable_answers") or []}
+    )
+    return question
+
+
+def correct_norm(payload: Dict[str, Any]) -> str:
+    stored = payload.get("correct_answer_norm")
+    if stored is None:  # sessions generated before the field existed
+        stored = _normalize(payload.get("correct_answer"))
+    return stored
+
+
+def acceptable_set(payload: Dict[str, Any]) -> FrozenSet[str]:
+    stored = payload.get("acceptable_answers_lower")
+    if stored is None:  # sessions generated before the field existed
+        stored = (str(a).lower() for a in payload.get("acceptable_answers") or [])
+    return frozenset(stored)
+
+
 def evaluate_answer(
     question_type: str,
-    correct_answer: Any,
     user_answer: Any,
-    acceptable_answers: Optional[List[str]] = None,
+    *,
+    expected_norm: str,
+    acceptable_answers: AbstractSet[str] = frozenset(),
 ) -> bool:
-    acceptable_answers = acceptable_answers or []
-    if question_type == "recall":
-        ua = str(user_answer).strip().lower()
-        if str(correct_answer).strip().lower() == ua:
-            return True
-        return ua in [a.lower() for a in acceptable_answers]
-    return str(user_answer).strip().lower() == str(correct_answer).strip().lower()
+    """expected_norm and acceptable_answers come from correct_norm()/acceptable_set()."""
+    ua = _normalize(user_answer)
+    if ua == expected_norm:
+        return True
+    return question_type == "recall" and ua in acceptable_answers
 
 
 def compute_mastery_update(
-    engine,
     patient_id: str,
     payload: Dict[str, Any],
     correct: bool,
     response_time_ms: int,
+    existing: Optional[Dict[str, Any]] = None,
+    now: Optional[datetime] = None,
 ):
     item_type = payload.get("item_type")
     item_id = payload.get("item_id")
     if not item_type or not item_id:
         return None
-    existing = db._get_mastery_row(engine, patient_id, item_type, item_id)  # type: ignore
     mastery_score = float(existing["mastery_score"]) if existing else 0.0
     consecutive_correct = int(existing["consecutive_correct"]) if existing else 0
     consecutive_incorrect = int(existing["consecutive_incorrect"]) if existing else 0
@@ -192,8 +387,8 @@ def compute_mastery_update(
         consecutive_incorrect += 1
         consecutive_correct = 0
         mastery_score = max(0.0, mastery_score - 0.05)
-    days = _interval_days(mastery_score)
-    next_due = datetime.utcnow() + timedelta(days=days)
+    now = now or datetime.utcnow()
+    next_due = now + timedelta(days=_interval_days(mastery_score))
     return {
         "patient_id": patient_id,
         "item_type": item_type,
@@ -201,6 +396,30 @@ def compute_mastery_update(
         "mastery_score": mastery_score,
         "consecutive_correct": consecutive_correct,
         "consecutive_incorrect": consecutive_incorrect,
-        "last_seen_at": datetime.utcnow(),
+        "last_seen_at": now,
         "next_due_at": next_due,
     }
+
+
+def compute_mastery_updates(
+    patient_id: str,
+    graded: Iterable[Tuple[Dict[str, Any], bool, int]],
+    existing_rows: Dict[Tuple[str, str], Dict[str, Any]],
+    now: Optional[datetime] = None,
+) -> List[Dict[str, Any]]:
+    """Fold graded (payload, correct, response_time_ms) answers into one update per item."""
+    now = now or datetime.utcnow()
+    updates: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for payload, correct, response_time_ms in graded:
+        key = (payload.get("item_type"), payload.get("item_id"))
+        update = compute_mastery_update(
+            patient_id,
+            payload,
+            correct,
+            response_time_ms,
+            existing=updates.get(key) or existing_rows.get(key),
+            now=now,
+        )
+        if update:
+            updates[key] = update
+    return list(updates.values())
@@ -1,29 +1,45 @@
 """Azure Blob and optional Cosmos logging helpers."""
 from __future__ import annotations
 
+import functools
 import os
-import re
+import string
 import uuid
 from datetime import datetime
-from typing import Optional, TYPE_CHECKING
+from typing import Dict, Optional, TYPE_CHECKING
 
 if TYPE_CHECKING:  # pragma: no cover
-    from azure.storage.blob import BlobServiceClient  # type: ignore
+    from azure.storage.blob.aio import BlobServiceClient, ContainerClient  # type: ignore
     from azure.cosmos import CosmosClient  # type: ignore
 
 from dotenv import load_dotenv
-from fastapi import UploadFile
+from fastapi import BackgroundTasks, UploadFile
 
 load_dotenv()
 
+# containers already verified/created in this process, keyed by name
+_containers: Dict[str, ContainerClient] = {}
+
+
+class _FilenameTable(dict):
+    """str.translate table: allowed characters map to themselves, anything else to "_"."""
+
+    def __missing__(self, codepoint: int) -> str:
+        return "_"
+
+
+_FILENAME_TABLE = _FilenameTable(
+    (ord(c), c) for c in string.ascii_letters + string.digits + "._-"
+)
+
 
 def _safe_filename(name: str) -> str:
-    name = re.sub(r"[^A-Za-z0-9._-]", "_", name)
-    return name
+    return name.translate(_FILENAME_TABLE)
 
 
+@functools.lru_cache(maxsize=1)
 def _get_blob_client() -> BlobServiceClient:
-    from azure.storage.blob import BlobServiceClient  # type: ignore
+    from azure.storage.blob.aio import BlobServiceClient  # type: ignore
 
     conn = os.getenv("BLOB_CONNECTION_STRING")
     if not conn:
@@ -31,13 +47,36 @@ def _get_blob_client() -> BlobServiceClient:
     return BlobServiceClient.from_connection_string(conn)
 
 
-def _ensure_container(client: BlobServiceClient, name: str):
-    container = client.get_container_client(name)
-    if not container.exists():
-        container.create_container()
+async def _ensure_container(client: BlobServiceClient, name: str) -> ContainerClient:
+    container = _containers.get(name)
+    if container is None:
+        from azure.core.exceptions import HttpResponseError, ResourceExistsError  # type: ignore
+
+        container = client.get_container_client(name)
+        # check first: container- or blob-scoped SAS credentials may not create containers
+        try:
+            missing = not await container.exists()
+        except HttpResponseError as exc:
+            if exc.status_code != 403:
+                raise
+            missing = False  # not allowed to inspect it; let the upload itself report errors
+        if missing:
+            try:
+                await container.create_container()
+            except ResourceExistsError:  # another worker created it first
+                pass
+        _containers[name] = container
     return container
 
 
+async def close_blob_client() -> None:
+    """Close the shared async blob client if one was created."""
+    if _get_blob_client.cache_info().currsize:
+        await _get_blob_client().close()
+        _get_blob_client.cache_clear()
+        _containers.clear()
+
+
 def _cosmos_client() -> Optional[CosmosClient]:
     try:
         from azure.cosmos import CosmosClient  # type: ignore
@@ -50,40 +89,58 @@ def _cosmos_client() -> Optional[CosmosClient]:
     return CosmosClient(endpoint, credential=key)
 
 
-async def upload_patient_document(patient_id: str, file: UploadFile) -> str:
+async def upload_patient_document(
+    patient_id: str, file: UploadFile, background_tasks: BackgroundTasks
+) -> str:
     blob_client = _get_blob_client()
-    container = _ensure_container(blob_client, "patient-docs")
+    container = await _ensure_container(blob_client, "patient-docs")
     fname = _safe_filename(file.filename or "upload")
-    blob_name = f"patient-docs/{patient_id}/{uuid.uuid4()}_{fname}"
+    blob_name = f"patient-docs/{patient_id}/{uuid.uuid4().hex}_{fname}"
     blob = container.get_blob_client(blob_name)
-    content = await file.read()
-    blob.upload_blob(content, overwrite=True)
-    _log_cosmos(patient_id, blob_name, fname)
+    # hand the spooled file to the SDK so it uploads in chunks instead of
+    # reading the whole document into memory first
+    await blob.upload_blob(
+        file.file, overwrite=True, length=file.size, max_concurrency=4
+    )
+    # ingestion logging is not on the caller's critical path
+    background_tasks.add_task(_log_cosmos, patient_id, blob_name, fname)
     return blob_name
 
 
 async def upload_family_photo(patient_id: str, family_id: str, file: UploadFile) -> str:
     blob_client = _get_blob_client()
-    container = _ensure_container(blob_client, "patient-photos")
-    blob_name = f"patient-photos/{patient_id}/{family_id}/{uuid.uuid4()}.jpg"
-    content = await file.read()
-    container.upload_blob(name=blob_name, data=content, overwrite=True)
+    container = await _ensure_container(blob_client, "patient-photos")
+    blob_name = f"patient-photos/{patient_id}/{family_id}/{uuid.uuid4().hex}.jpg"
+    await container.upload_blob(
+        name=blob_name,
+        data=file.file,
+        overwrite=True,
+        length=file.size,
+        max_concurrency=4,
+    )
     return blob_name
 
 
-def _log_cosmos(patient_id: str, blob_path: str, filename: str):
+@functools.lru_cache(maxsize=1)
+def _cosmos_container():
     client = _cosmos_client()
     if not client:
-        return
+        return None
     from azure.cosmos import PartitionKey  # type: ignore
 
     database = client.create_database_if_not_exists(id="reinforce_db")
-    container = database.create_container_if_not_exists(
+    return database.create_container_if_not_exists(
         id="ingestion_logs", partition_key=PartitionKey(path="/patient_id")
     )
+
+
+def _log_cosmos(patient_id: str, blob_path: str, filename: str):
+    container = _cosmos_container()
+    if not container:
+        return
     container.upsert_item(
         {
-            "id": str(uuid.uuid4()),
+            "id": uuid.uuid4().hex,
             "patient_id": patient_id,
             "blob_path": blob_path,
             "filename": filename,
@@ -1,17 +1,21 @@
 import os
 import json
+from datetime import datetime, timedelta
 import pytest
 from fastapi.testclient import TestClient
 
 os.environ["SQL_CONNECTION_STRING"] = "sqlite+pysqlite:///:memory:"
 os.environ["APP_API_KEY"] = "test-key"
 
+import db  # noqa: E402
 import main  # noqa: E402
 import quiz  # noqa: E402
+import storage  # noqa: E402
 
 
 @pytest.fixture
 def client():
+    db.clear_patient_cache()
     with TestClient(main.app) as c:
         yield c
 
@@ -26,6 +30,12 @@ def test_health(client):
     assert resp.json()["status"] == "ok"
 
 
+def test_rejects_invalid_api_key(client):
+    assert client.get("/patients").status_code == 401
+    resp = client.get("/patients", headers={"X-API-KEY": "wrong-key"})
+    assert resp.status_code == 401
+
+
 def test_patient_crud(client):
     payload = {
         "full_name": "Alice",
@@ -63,7 +73,7 @@ def test_quiz_flow(client, monkeypatch):
     )
     knowledge_id = ki_resp.json()["id"]
 
-    def fake_generate(**kwargs):
+    async def fake_generate(**kwargs):
         return [
             {
                 "question_type": "recall",
@@ -77,7 +87,7 @@ def test_quiz_flow(client, monkeypatch):
             }
         ]
 
-    monkeypatch.setattr(quiz, "generate_quiz_questions", fake_generate)
+    monkeypatch.setattr(quiz, "agenerate_quiz_questions", fake_generate)
 
     gen_resp = client.post(
         f"/patients/{patient_id}/quiz/generate",
@@ -102,3 +112,400 @@ def test_quiz_flow(client, monkeypatch):
     assert submit_resp.status_code == 200
     result = submit_resp.json()
     assert result["score"] == 1.0
+
+
+def test_submit_accepts_integers_wider_than_64_bits(client, monkeypatch):
+    big = 10**30
+    patient_id = client.post(
+        "/patients",
+        json={"full_name": "Hal", "dob": "1939-05-05"},
+        headers=auth_headers(),
+    ).json()["id"]
+
+    async def fake_generate(**kwargs):
+        return [
+            {
+                "question_type": "recall",
+                "prompt": "What is your lucky number?",
+                "correct_answer": big,
+                "item_type": "knowledge",
+                "item_id": "lucky",
+                "difficulty": 1,
+            }
+        ]
+
+    monkeypatch.setattr(quiz, "agenerate_quiz_questions", fake_generate)
+    data = client.post(
+        f"/patients/{patient_id}/quiz/generate", headers=auth_headers()
+    ).json()
+    resp = client.post(
+        f"/quiz/{data['session_id']}/submit",
+        headers=auth_headers(),
+        json=[
+            {
+                "question_id": data["questions"][0]["question_id"],
+                "user_answer": big,
+                "response_time_ms": 1000,
+            }
+        ],
+    )
+    assert resp.status_code == 200
+    assert resp.json()["score"] == 1.0
+    stored = db.list_questions(db.get_engine(), data["session_id"])[0]["payload_json"]
+    assert stored["correct_answer"] == big
+    assert quiz.correct_norm({"correct_answer": stored["correct_answer"]}) == str(big)
+    assert db.json_loads(db.json_dumps([big, -big])) == [big, -big]
+    assert db.json_loads(b"[12345678901234567890123]") == [12345678901234567890123]
+
+
+def test_resubmit_updates_single_mastery_row(client, monkeypatch):
+    patient_id = client.post(
+        "/patients",
+        json={"full_name": "Carol", "dob": "1945-02-02"},
+        headers=auth_headers(),
+    ).json()["id"]
+    knowledge_id = client.post(
+        f"/patients/{patient_id}/knowledge",
+        json={"category": "personal", "label": "pet", "value": "Rex"},
+        headers=auth_headers(),
+    ).json()["id"]
+
+    async def fake_generate(**kwargs):
+        return [
+            {
+                "question_type": "recall",
+                "prompt": "What is your pet's name?",
+                "correct_answer": "Rex",
+                "item_type": "knowledge",
+                "item_id": knowledge_id,
+                "difficulty": 1,
+            }
+        ]
+
+    monkeypatch.setattr(quiz, "agenerate_quiz_questions", fake_generate)
+
+    for _ in range(2):
+        data = client.post(
+            f"/patients/{patient_id}/quiz/generate", headers=auth_headers()
+        ).json()
+        resp = client.post(
+            f"/quiz/{data['session_id']}/submit",
+            headers=auth_headers(),
+            json=[
+                {
+                    "question_id": data["questions"][0]["question_id"],
+                    "user_answer": "rex",
+                    "response_time_ms": 1000,
+                }
+            ],
+        )
+        assert resp.status_code == 200
+
+    with db.get_engine().connect() as conn:
+        rows = conn.execute(
+            db.select(db.mastery).where(db.mastery.c.item_id == knowledge_id)
+        ).all()
+    assert len(rows) == 1
+    assert rows[0].consecutive_correct == 2
+    summary = client.get(
+        f"/patients/{patient_id}/analytics/summary", headers=auth_headers()
+    ).json()
+    assert summary["accuracy_by_category"]["knowledge"] == 1.0
+    assert f"knowledge:{knowledge_id}" in summary["next_due"]
+
+
+def test_due_items_lists_due_mastery_before_unscheduled_items(client):
+    engine = db.get_engine()
+    patient_id = db.create_patient(engine, {"full_name": "Ivy", "dob": "1937-06-06"})["id"]
+    fact = db.add_knowledge_item(
+        engine, patient_id, {"category": "home", "label": "street", "value": "Elm", "sensitivity_level": 1}
+    )["id"]
+    due, later, unseen = (
+        db.add_family_member(engine, patient_id, {"full_name": name, "relationship": "friend"})["id"]
+        for name in ("Jo", "Kim", "Lee")
+    )
+    now = datetime.utcnow()
+    db.upsert_mastery_bulk(
+        engine,
+        [
+            {"patient_id": patient_id, "item_type": "family", "item_id": item_id,
+             "mastery_score": 0.5, "consecutive_correct": 1, "consecutive_incorrect": 0,
+             "last_seen_at": now, "next_due_at": now + offset}
+            for item_id, offset in ((due, timedelta(days=-1)), (later, timedelta(days=3)))
+        ],
+    )
+    rows = db.due_items(engine, patient_id)
+    assert [r["item_id"] for r in rows] == [due, later, unseen, fact]
+    assert rows[0]["last_seen_at"] is not None
+    assert set(rows[0]) == {"item_type", "item_id", "next_due_at", "last_seen_at"}
+    assert all(r["last_seen_at"] is None for r in rows[1:])
+    assert "sensitivity_level" not in rows[1]
+    assert rows[3]["sensitivity_level"] == 1
+
+
+def test_generate_quiz_falls_back_without_openai(client):
+    patient_id = client.post(
+        "/patients",
+        json={"full_name": "Dan", "dob": "1938-03-03"},
+        headers=auth_headers(),
+    ).json()["id"]
+    family_id = client.post(
+        f"/patients/{patient_id}/family",
+        json={"full_name": "Erin", "relationship": "daughter"},
+        headers=auth_headers(),
+    ).json()["id"]
+    resp = client.post(
+        f"/patients/{patient_id}/quiz/generate",
+        headers=auth_headers(),
+        params={"n": 1},
+    )
+    assert resp.status_code == 200
+    questions = resp.json()["questions"]
+    assert len(questions) == 1
+    assert questions[0]["item_type"] == "family"
+    assert questions[0]["item_id"] == family_id
+
+
+def test_new_items_reach_quiz_despite_cached_context(client):
+    patient_id = client.post(
+        "/patients",
+        json={"full_name": "Max", "dob": "1936-07-07"},
+        headers=auth_headers(),
+    ).json()["id"]
+
+    def quiz_item_ids():
+        resp = client.post(
+            f"/patients/{patient_id}/quiz/generate", headers=auth_headers(), params={"n": 10}
+        )
+        return {q["item_id"] for q in resp.json()["questions"]}
+
+    assert quiz_item_ids() == set()
+    family_id = client.post(
+        f"/patients/{patient_id}/family",
+        json={"full_name": "Ned", "relationship": "brother"},
+        headers=auth_headers(),
+    ).json()["id"]
+    assert quiz_item_ids() == {family_id}
+    knowledge_id = client.post(
+        f"/patients/{patient_id}/knowledge",
+        json={"category": "personal", "label": "hobby", "value": "chess"},
+        headers=auth_headers(),
+    ).json()["id"]
+    assert quiz_item_ids() == {family_id, knowledge_id}
+    db.update_family_photo(db.get_engine(), patient_id, family_id, "photos/ned.jpg")
+    _, family, _ = db.quiz_context(db.get_engine(), patient_id)
+    assert family[0]["photo_blob_path"] == "photos/ned.jpg"
+
+
+def test_quiz_context_not_cached_when_invalidated_during_read(client, monkeypatch):
+    engine = db.get_engine()
+    patient_id = db.create_patient(engine, {"full_name": "Olga", "dob": "1935-08-08"})["id"]
+    list_family = db.list_family_members
+
+    def racing_list_family(engine, pid):
+        rows = list_family(engine, pid)
+        # a concurrent add_family_member commits and invalidates after our read
+        db.add_family_member(engine, pid, {"full_name": "Pia", "relationship": "niece"})
+        return rows
+
+    monkeypatch.setattr(db, "list_family_members", racing_list_family)
+    _, family, _ = db.quiz_context(engine, patient_id)
+    assert family == []
+    assert patient_id not in db.patient_cache
+    monkeypatch.setattr(db, "list_family_members", list_family)
+    _, family, _ = db.quiz_context(engine, patient_id)
+    assert [f["full_name"] for f in family] == ["Pia"]
+
+
+def test_generate_quiz_stream_persists_session(client):
+    patient_id = client.post(
+        "/patients",
+        json={"full_name": "Fay", "dob": "1941-04-04"},
+        headers=auth_headers(),
+    ).json()["id"]
+    client.post(
+        f"/patients/{patient_id}/family",
+        json={"full_name": "Gus", "relationship": "son"},
+        headers=auth_headers(),
+    )
+    resp = client.post(
+        f"/patients/{patient_id}/quiz/generate/stream", headers=auth_headers()
+    )
+    assert resp.status_code == 200
+    *questions, final = [json.loads(line) for line in resp.text.splitlines()]
+    assert len(questions) == 1
+    submit = client.post(
+        f"/quiz/{final['session_id']}/submit",
+        headers=auth_headers(),
+        json=[
+            {
+                "question_id": questions[0]["question_id"],
+                "user_answer": "Gus",
+                "response_time_ms": 1000,
+            }
+        ],
+    )
+    assert submit.json()["score"] == 1.0
+
+
+def test_sync_generate_uses_a_client_per_event_loop(monkeypatch):
+    import asyncio
+    from types import SimpleNamespace
+
+    loops = []
+
+    class FakeClient:
+        def __init__(self):
+            self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return None
+
+        async def create(self, **kwargs):
+            loops.append((self, asyncio.get_running_loop()))
+            content = json.dumps({"questions": [{"prompt": "from the llm"}]})
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    monkeypatch.setattr(quiz, "_build_client", lambda cls: FakeClient())
+    for _ in range(2):
+        assert quiz.generate_quiz_questions({}, [], [], [], n=1) == [{"prompt": "from the llm"}]
+    (first, first_loop), (second, second_loop) = loops
+    assert first is not second and first_loop is not second_loop
+
+
+def test_review_interval_boundaries():
+    # thresholds belong to the longer interval (bisect_right, not bisect_left)
+    expected = {0.0: 1, 0.19: 1, 0.2: 2, 0.4: 4, 0.6: 7, 0.8: 14, 1.0: 14}
+    assert {score: quiz._interval_days(score) for score in expected} == expected
+
+
+def test_stream_parser_splits_questions_across_chunks():
+    text = json.dumps({"questions": [{"prompt": 'say "}"', "options": ["a"]}, {"prompt": "b"}]})
+    parser = quiz._QuestionStreamParser()
+    found = []
+    for i in range(0, len(text), 3):
+        found += parser.feed(text[i : i + 3])
+    assert found == [{"prompt": 'say "}"', "options": ["a"]}, {"prompt": "b"}]
+
+
+def test_safe_filename_replaces_unsafe_characters():
+    assert storage._safe_filename("scan 01 (final).pdf") == "scan_01__final_.pdf"
+    assert storage._safe_filename("../résumé_ü.txt") == ".._r_sum___.txt"
+
+
+def test_recall_matches_acceptable_answers():
+    payload = quiz.prepare_question(
+        {"question_type": "recall", "correct_answer": "Rex", "acceptable_answers": ["Rexy"]}
+    )
+    legacy = {"question_type": "recall", "correct_answer": "Rex", "acceptable_answers": ["Rexy"]}
+    for p in (payload, legacy):
+        grade = {"expected_norm": quiz.correct_norm(p), "acceptable_answers": quiz.acceptable_set(p)}
+        assert quiz.evaluate_answer("recall", " REX", **grade)
+        assert quiz.evaluate_answer("recall", " rexy ", **grade)
+        assert not quiz.evaluate_answer("recall", "Max", **grade)
+    with pytest.raises(TypeError):
+        quiz.evaluate_answer("mcq", "Paris", "paris")
+
+
+def _baseline_engine():
+    # tables as created by releases before the current schema
+    engine = db.create_engine("sqlite://", json_serializer=db.json_dumps)
+    with engine.begin() as conn:
+        conn.execute(db.text(
+            "CREATE TABLE quiz_questions (id VARCHAR(36) PRIMARY KEY, session_id VARCHAR(36) NOT NULL,"
+            " question_type VARCHAR(50) NOT NULL, payload_json VARCHAR(4000) NOT NULL,"
+            " correct_answer_json VARCHAR(2000), created_at DATETIME)"
+        ))
+        conn.execute(db.text(
+            "CREATE TABLE mastery (id VARCHAR(36) PRIMARY KEY, patient_id VARCHAR(36) NOT NULL,"
+            " item_type VARCHAR(20) NOT NULL, item_id VARCHAR(36) NOT NULL, mastery_score FLOAT,"
+            " consecutive_correct INTEGER, consecutive_incorrect INTEGER,"
+            " last_seen_at DATETIME, next_due_at DATETIME)"
+        ))
+        conn.execute(db.text(
+            "CREATE TABLE quiz_responses (id VARCHAR(36) PRIMARY KEY, session_id VARCHAR(36) NOT NULL,"
+            " question_id VARCHAR(36) NOT NULL, user_answer_json VARCHAR(2000), correct BOOLEAN,"
+            " response_time_ms INTEGER, created_at DATETIME)"
+        ))
+    return engine
+
+
+def test_create_tables_upgrades_existing_schema():
+    engine = _baseline_engine()
+    db.create_tables(engine)
+    db.create_tables(engine)
+    insp = db.inspect(engine)
+    assert "item_type" in {c["name"] for c in insp.get_columns("quiz_questions")}
+    for table in db.metadata.sorted_tables:
+        names = {i["name"] for i in insp.get_indexes(table.name)}
+        assert {ix.name for ix in table.indexes} <= names
+    assert {"ix_quiz_questions_item_type", "ix_quiz_questions_session_id"} <= {
+        i["name"] for i in insp.get_indexes("quiz_questions")
+    }
+    assert "ix_mastery_due" in {i["name"] for i in insp.get_indexes("mastery")}
+    assert "ix_qr_created" in {i["name"] for i in insp.get_indexes("quiz_responses")}
+    question = {"question_type": "mcq", "item_type": "family", "item_id": "x"}
+    assert len(db.add_questions_bulk(engine, "s1", [question])) == 1
+
+
+def test_create_tables_backfills_question_item_type():
+    engine = _baseline_engine()
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(db.text(
+            "INSERT INTO quiz_questions (id, session_id, question_type, payload_json, created_at)"
+            " VALUES ('q1', 's1', 'mcq', :payload, :now), ('q2', 's1', 'mcq', 'not json', :now)"
+        ), {"payload": json.dumps({"item_type": "family", "item_id": "f"}), "now": now})
+        conn.execute(db.text(
+            "INSERT INTO quiz_responses (id, session_id, question_id, correct, created_at)"
+            " VALUES ('r1', 's1', 'q1', 1, :now)"
+        ), {"now": now})
+    db.create_tables(engine)
+    with engine.connect() as conn:
+        types = dict(conn.execute(db.select(db.quiz_questions.c.id, db.quiz_questions.c.item_type)).all())
+    assert types == {"q1": "family", "q2": None}
+    assert db.analytics_summary(engine, "p")["accuracy_by_category"] == {"family": 1.0}
+
+
+def test_create_tables_without_unique_constraint_reflection(monkeypatch):
+    # the mssql dialect cannot reflect unique constraints, only unique indexes
+    engine = _baseline_engine()
+
+    def not_implemented(*args, **kwargs):
+        raise NotImplementedError()
+
+    monkeypatch.setattr(engine.dialect, "get_unique_constraints", not_implemented)
+    db.create_tables(engine)
+    db.create_tables(engine)
+    indexes = {i["name"]: i for i in db.inspect(engine).get_indexes("mastery")}
+    assert indexes["uq_mastery_item"]["unique"]
+
+
+def test_create_tables_dedupes_mastery_before_adding_unique_key():
+    engine = _baseline_engine()
+    old, new = datetime(2024, 1, 1), datetime(2024, 2, 1)
+    with engine.begin() as conn:
+        conn.execute(
+            db.mastery.insert(),
+            [
+                {"id": "a", "patient_id": "p", "item_type": "family", "item_id": "f",
+                 "consecutive_correct": 1, "last_seen_at": old},
+                {"id": "b", "patient_id": "p", "item_type": "family", "item_id": "f",
+                 "consecutive_correct": 2, "last_seen_at": new},
+            ],
+        )
+    db.create_tables(engine)
+    db.create_tables(engine)
+    with engine.connect() as conn:
+        existing = db._get_mastery_row(conn, "p", "family", "f")
+    update = quiz.compute_mastery_update(
+        "p", {"item_type": "family", "item_id": "f"}, True, 1000, existing=existing
+    )
+    db.upsert_mastery_bulk(engine, [update])
+    with engine.connect() as conn:
+        rows = conn.execute(db.select(db.mastery)).all()
+    assert len(rows) == 1
+    assert rows[0].consecutive_correct == 3